@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+"""Offline load test for the Twilio <-> OpenAI relay.
+
+Starts voice_server.app in a uvicorn subprocess pointed at a local stand-in
+for the OpenAI Realtime websocket, then runs simulated Twilio media-stream
+clients that push 20 ms μ-law frames in real time. Each stage reports relay
+latency in both directions, plus CPU and memory per call measured on the
+server process.
+
+    python benchmarks/load_test.py --calls 5,10,20 --duration 10 --json out.json
+
+Every audio frame carries a sequence id in its first bytes, so the latency
+of each frame is measured end to end through the server, including when
+inbound frames are coalesced. CPU and memory are read from /proc (Linux).
+Server settings such as AUDIO_COALESCE_MS are passed through from the
+environment, so relay modes can be compared with the same script.
+"""
+import os
+import sys
+import json
+import time
+import base64
+import socket
+import struct
+import asyncio
+import argparse
+import subprocess
+
+import aiohttp
+from aiohttp import web
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+FRAME_BYTES = 160  # 20 ms of 8 kHz μ-law, what Twilio sends
+DELTA_BYTES = 800  # 100 ms per scripted response.audio.delta
+MAGIC = b'\xa5\x5a'
+SILENCE = b'\xff'
+
+def tagged_audio(seq, size):
+    """μ-law bytes whose first 8 bytes carry a sequence id."""
+    return MAGIC + struct.pack('>Q', seq)[2:] + SILENCE * (size - 8)
+
+def read_tags(audio, size):
+    """Sequence ids found at each size-aligned chunk of decoded audio."""
+    tags = []
+    for offset in range(0, len(audio) - 7, size):
+        if audio[offset:offset + 2] == MAGIC:
+            tags.append(struct.unpack('>Q', b'\0\0' + audio[offset + 2:offset + 8])[0])
+    return tags
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class Stats:
+    def __init__(self):
+        self.next_seq = 0
+        self.reset()
+
+    def reset(self):
+        self.sent_at = {}  # seq -> perf_counter when the frame left its origin
+        self.inbound_ms = []  # Twilio client -> fake OpenAI
+        self.outbound_ms = []  # fake OpenAI -> Twilio client
+        self.calls_ok = 0
+        self.calls_failed = 0
+
+    def tag(self):
+        self.next_seq += 1
+        self.sent_at[self.next_seq] = time.perf_counter()
+        return self.next_seq
+
+    def arrived(self, seq, latencies):
+        sent_at = self.sent_at.pop(seq, None)
+        if sent_at is not None:
+            latencies.append((time.perf_counter() - sent_at) * 1000)
+
+class FakeRealtime:
+    """Scripted stand-in for the OpenAI Realtime websocket.
+
+    Every turn_ms of caller audio it plays out a turn: speech_started,
+    speech_stopped 500 ms later, then a response of response_ms audio sent
+    at twice real time followed by response.done. The greeting requested
+    with response.create gets the same scripted response.
+    """
+
+    def __init__(self, stats, turn_ms, response_ms):
+        self.stats = stats
+        self.turn_bytes = turn_ms * 8
+        self.response_ms = response_ms
+
+    async def handle(self, request):
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        await ws.send_str(json.dumps({"type": "session.created"}))
+        caller_bytes = 0
+        tasks = set()
+
+        def spawn(coro):
+            task = asyncio.create_task(coro)
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        try:
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    break
+                event = json.loads(msg.data)
+                if event['type'] == 'input_audio_buffer.append':
+                    audio = base64.b64decode(event['audio'])
+                    for seq in read_tags(audio, FRAME_BYTES):
+                        self.stats.arrived(seq, self.stats.inbound_ms)
+                    caller_bytes += len(audio)
+                    if caller_bytes >= self.turn_bytes:
+                        caller_bytes = 0
+                        spawn(self.turn(ws))
+                elif event['type'] == 'session.update':
+                    await ws.send_str(json.dumps({"type": "session.updated"}))
+                elif event['type'] == 'response.create':
+                    spawn(self.respond(ws))
+        finally:
+            for task in tasks:
+                task.cancel()
+        return ws
+
+    async def turn(self, ws):
+        await ws.send_str(json.dumps({"type": "input_audio_buffer.speech_started"}))
+        await asyncio.sleep(0.5)
+        await ws.send_str(json.dumps({"type": "input_audio_buffer.speech_stopped"}))
+        await self.respond(ws)
+
+    async def respond(self, ws):
+        item_id = f"item_{self.stats.next_seq}"
+        for _ in range(self.response_ms // 100):
+            delta = base64.b64encode(tagged_audio(self.stats.tag(), DELTA_BYTES)).decode()
+            await ws.send_str(json.dumps({"type": "response.audio.delta", "item_id": item_id, "delta": delta}))
+            await asyncio.sleep(0.05)
+        await ws.send_str(json.dumps({"type": "response.done", "response": {"status": "completed"}}))
+
+async def twilio_call(port, index, duration, stats):
+    """One simulated Twilio media stream, pushing 20 ms frames in real time."""
+    loop = asyncio.get_running_loop()
+    stream_sid = f"MZ{index:032d}"
+    playback_end = 0.0
+    pending_marks = []
+
+    def ack_marks(ws, now):
+        while pending_marks and pending_marks[0][0] <= now:
+            _, name = pending_marks.pop(0)
+            asyncio.ensure_future(ws.send_str(json.dumps(
+                {"event": "mark", "streamSid": stream_sid, "mark": {"name": name}})))
+
+    async def read(ws):
+        nonlocal playback_end
+        async for msg in ws:
+            event = json.loads(msg.data)
+            now = loop.time()
+            if event['event'] == 'media':
+                audio = base64.b64decode(event['media']['payload'])
+                for seq in read_tags(audio, DELTA_BYTES):
+                    stats.arrived(seq, stats.outbound_ms)
+                playback_end = max(playback_end, now) + len(audio) / 8000
+            elif event['event'] == 'mark':
+                # Twilio echoes a mark once the audio before it has played
+                pending_marks.append((playback_end, event['mark']['name']))
+            elif event['event'] == 'clear':
+                playback_end = now
+                pending_marks[:] = [(now, name) for _, name in pending_marks]
+            ack_marks(ws, now)
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.ws_connect(f'ws://127.0.0.1:{port}/media-stream') as ws:
+                await ws.send_str(json.dumps({"event": "connected", "protocol": "Call"}))
+                await ws.send_str(json.dumps({"event": "start", "start": {"streamSid": stream_sid}}))
+                reader = asyncio.create_task(read(ws))
+                started = loop.time()
+                for frame in range(int(duration * 50)):
+                    # Absolute schedule so the 20 ms cadence does not drift
+                    await asyncio.sleep(max(0.0, started + frame * 0.02 - loop.time()))
+                    payload = base64.b64encode(tagged_audio(stats.tag(), FRAME_BYTES)).decode()
+                    await ws.send_str(json.dumps({"event": "media", "streamSid": stream_sid, "media": {
+                        "track": "inbound", "timestamp": str(frame * 20), "payload": payload}}))
+                    ack_marks(ws, loop.time())
+                await ws.send_str(json.dumps({"event": "stop", "streamSid": stream_sid}))
+                reader.cancel()
+        stats.calls_ok += 1
+    except Exception as e:
+        print(f"call {index} failed: {e}", file=sys.stderr)
+        stats.calls_failed += 1
+
+def process_usage(pid):
+    """CPU seconds and resident memory in bytes for a process, from /proc."""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    with open(f'/proc/{pid}/statm') as f:
+        rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    return cpu, rss
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+async def wait_until_up(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(f'http://127.0.0.1:{port}/') as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("voice_server did not start")
+
+async def run_stage(port, pid, calls, duration, stats):
+    cpu_before, rss_before = process_usage(pid)
+    peak_rss = rss_before
+    started = time.perf_counter()
+    stage = asyncio.gather(*(twilio_call(port, index, duration, stats) for index in range(calls)))
+    while not stage.done():
+        await asyncio.sleep(0.25)
+        peak_rss = max(peak_rss, process_usage(pid)[1])
+    await stage
+    elapsed = time.perf_counter() - started
+    cpu_after, _ = process_usage(pid)
+    return {
+        "calls": calls,
+        "calls_failed": stats.calls_failed,
+        "inbound_p50_ms": percentile(stats.inbound_ms, 0.5),
+        "inbound_p99_ms": percentile(stats.inbound_ms, 0.99),
+        "outbound_p50_ms": percentile(stats.outbound_ms, 0.5),
+        "outbound_p99_ms": percentile(stats.outbound_ms, 0.99),
+        "frames_lost": len(stats.sent_at),
+        "cpu_percent_per_call": (cpu_after - cpu_before) / elapsed / calls * 100,
+        "memory_kb_per_call": (peak_rss - rss_before) / calls / 1024,
+    }
+
+async def main(args):
+    stats = Stats()
+    fake = FakeRealtime(stats, args.turn_ms, args.response_ms)
+    fake_app = web.Application()
+    fake_app.router.add_get('/v1/realtime', fake.handle)
+    runner = web.AppRunner(fake_app)
+    await runner.setup()
+    fake_port = free_port()
+    await web.TCPSite(runner, '127.0.0.1', fake_port).start()
+
+    port = free_port()
+    env = dict(
+        os.environ,
+        OPENAI_API_KEY='load-test',
+        OPENAI_REALTIME_URL=f'ws://127.0.0.1:{fake_port}/v1/realtime',
+        GREETING_CACHE_DIR='',
+        CALL_LOG_PATH='',  # Keep load-test calls out of the call history
+        LOG_LEVEL='WARNING',
+    )
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'voice_server:app', '--host', '127.0.0.1',
+         '--port', str(port), '--log-level', 'warning'],
+        cwd=ROOT, env=env,
+    )
+    results = []
+    try:
+        await wait_until_up(port)
+        await asyncio.sleep(1)  # Let the pool and greeting cache warm up
+        for calls in args.calls:
+            stats.reset()
+            result = await run_stage(port, server.pid, calls, args.duration, stats)
+            results.append(result)
+            print(
+                f"{calls:>5} calls  failed {result['calls_failed']:>3}  lost {result['frames_lost']:>5}  "
+                f"in p50/p99 {result['inbound_p50_ms']:6.1f}/{result['inbound_p99_ms']:6.1f} ms  "
+                f"out p50/p99 {result['outbound_p50_ms']:6.1f}/{result['outbound_p99_ms']:6.1f} ms  "
+                f"cpu/call {result['cpu_percent_per_call']:5.2f}%  "
+                f"mem/call {result['memory_kb_per_call']:7.1f} KB"
+            )
+    finally:
+        server.terminate()
+        try:
+            # Wait off the loop: the fake OpenAI peer has to answer close handshakes
+            await asyncio.to_thread(server.wait, timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        await runner.cleanup()
+
+    within_budget = [
+        r['calls'] for r in results
+        if not r['calls_failed'] and max(r['inbound_p99_ms'], r['outbound_p99_ms']) <= args.p99_budget_ms
+    ]
+    max_calls = max(within_budget, default=0)
+    print(f"max concurrent calls per worker within {args.p99_budget_ms} ms p99: {max_calls}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"max_calls": max_calls, "stages": results, "args": vars(args)}, f, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--calls', type=lambda value: [int(n) for n in value.split(',')], default=[5, 10, 20],
+                        help="comma separated concurrent call counts, one stage each")
+    parser.add_argument('--duration', type=float, default=10, help="seconds of caller audio per call")
+    parser.add_argument('--turn-ms', type=int, default=3000, help="caller audio between scripted turns")
+    parser.add_argument('--response-ms', type=int, default=1500, help="audio per scripted response")
+    parser.add_argument('--p99-budget-ms', type=float, default=50, help="p99 relay latency budget")
+    parser.add_argument('--json', help="write results to this file for comparing commits")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""Micro-benchmark: keyword-chain detect_response_style vs the compiled matcher.
+
+Run with `python benchmarks/style_matcher.py`. No network access is needed.
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+
+from voice_server import StyleClassifier, detect_response_style  # noqa: E402
+
+CORPUS = [
+    "السلام عليكم، أبغى أعرف إذا فيه وظيفة شاغرة عندكم",
+    "هل عندكم فرص عمل لحديثي التخرج في مجال الذكاء الاصطناعي",
+    "كيف طريقة التقديم على التدريب التعاوني في كاكست",
+    "أنا طالب في جامعة الملك سعود وأدور فرصة تدريب صيفي",
+    "ممكن تعطيني رقم التواصل أو البريد الرسمي حقكم",
+    "وين موقعكم بالضبط في الرياض",
+    "وش كاكست وش تسوون بالضبط",
+    "ما هي المجالات اللي تشتغل عليها المدينة",
+    "عندي مشروع في الطاقة المتجددة وأبغى دعم له",
+    "عندي فكره تطبيق يساعد المزارعين، كيف أقدم على دعم",
+    "أبي أعرف عن برامج الإبتكار والحلول المبتكرة",
+    "فيه برنامج للطلاب في المرحلة الثانوية؟",
+    "أحتاج دعم دراسي لبحث الماجستير",
+    "لو سمحت حوّلني على موظف",
+    "ابغى اكلم شخص حقيقي لو سمحت",
+    "حوِّل المكالمة لخدمة العملاء",
+    "شكرًا لك يعطيك العافية",
+    "خلاص تمام مع السلامة",
+    "صباح الخير، كيف حالك",
+    "أبغى أسأل عن الأبحاث في مجال الصحة والبيئة والاستدامة",
+]
+
+def legacy_detect_response_style(user_text):
+    """The if/elif keyword chain that detect_response_style used to be."""
+    if any(word in user_text for word in ["وظيفة", "توظيف", "تقديم", "فرص عمل"]):
+        return "رسمي"
+    elif any(word in user_text for word in ["تدريب تعاوني", "برنامج تعاوني", "فرصة تدريب", "تعاون أكاديمي"]):
+        return "تدريب تعاوني"
+    elif any(word in user_text for word in ["موقعكم", "رقم", "بريد", "تواصل", "عنوان"]):
+        return "معلومات اتصال"
+    elif any(word in user_text for word in ["كاكست", "ما هي", "وش كاكست", "تعريف"]):
+        return "تعريفي"
+    elif any(word in user_text for word in ["مشروع", "عندي مشروع", "أبغى دعم", "كيف أقدم على دعم", "عندي فكرة"]):
+        return "دعم مشاريع"
+    elif any(word in user_text for word in ["ابتكار", "أفكار جديدة", "حلول مبتكرة"]):
+        return "ابتكار"
+    elif any(word in user_text for word in ["طلاب", "برنامج للطلاب", "دعم الطلاب", "طلبة", "فرصة طلابية", "أحتاج دعم دراسي"]):
+        return "دعم طلاب"
+    elif any(word in user_text for word in ["حولني", "أبغى أكلم شخص", "حوّل المكالمة", "حول المكالمة"]):
+        return "طلب تحويل"
+    elif any(word in user_text for word in ["شكراً", "خلاص", "مع السلامة"]):
+        return "وداع"
+    else:
+        return "عام"
+
+def deltas(text):
+    """Split an utterance into word-sized transcript deltas."""
+    words = text.split(' ')
+    return [word + ' ' for word in words[:-1]] + words[-1:]
+
+# Whole calls as transcript deltas: user_question keeps growing until hang-up.
+# The small-talk call never hits a keyword, so the keyword chain rescans the
+# entire transcript for every list on every delta.
+CALLS = {
+    "corpus call": CORPUS,
+    "small-talk call": [
+        "صباح الخير، كيف حالك",
+        "أبغى أسأل عن الأبحاث في مجال الصحة والبيئة والاستدامة",
+        "طيب وإيش آخر الأخبار عندكم هالسنة",
+    ] * 10,
+}
+
+def call_deltas(utterances):
+    return [delta for utterance in utterances for delta in deltas(utterance + ' ')]
+
+def legacy_streaming(call):
+    user_question = ""
+    for delta in call:
+        user_question += delta
+        legacy_detect_response_style(user_question)
+
+def incremental_streaming(call):
+    classifier = StyleClassifier()
+    for delta in call:
+        classifier.feed(delta)
+
+def report(name, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print(f"{name:<34} {seconds * 1e6:10.1f} us")
+    return seconds
+
+def main():
+    print(f"{len(CORPUS)} utterances\n")
+    print(f"{'utterance':<48} {'legacy':<16} compiled")
+    for utterance in CORPUS:
+        legacy, compiled = legacy_detect_response_style(utterance), detect_response_style(utterance)
+        marker = '' if legacy == compiled else '  *'
+        print(f"{utterance[:46]:<48} {legacy:<16} {compiled}{marker}")
+    print("\n* differs only because the compiled matcher normalizes Arabic spelling\n")
+
+    number = 200
+    print("Each utterance classified once:")
+    one_shot_legacy = report("  legacy", lambda: [legacy_detect_response_style(u) for u in CORPUS], number)
+    one_shot_compiled = report("  compiled", lambda: [detect_response_style(u) for u in CORPUS], number)
+    print(f"  speedup {one_shot_legacy / one_shot_compiled:.2f}x")
+    for name, utterances in CALLS.items():
+        call = call_deltas(utterances)
+        print(f"{name.capitalize()}, classified after each of {len(call)} deltas:")
+        stream_legacy = report("  legacy, rescan user_question", lambda: legacy_streaming(call), number)
+        stream_incremental = report("  compiled, incremental", lambda: incremental_streaming(call), number)
+        print(f"  speedup {stream_legacy / stream_incremental:.2f}x")
+
+if __name__ == "__main__":
+    main()
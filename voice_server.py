@@ -1,20 +1,88 @@
 #!/usr/bin/env python
 import os
+import re
+import sys
 import json
+import time
+import queue
+import signal
+import atexit
+import bisect
+import hashlib
 import base64
 import asyncio
-import aiohttp  # Use aiohttp instead of websockets for OpenAI connection
+import logging
+import functools
+import importlib
+from logging.handlers import QueueHandler, QueueListener
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+try:
+    import orjson  # Optional fast JSON backend for the audio relay path
+except ImportError:
+    orjson = None
 from fastapi import FastAPI, WebSocket, Request
-from fastapi.responses import HTMLResponse, JSONResponse
-from fastapi.websockets import WebSocketDisconnect
-from twilio.twiml.voice_response import VoiceResponse, Connect, Say, Stream
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
+from fastapi.websockets import WebSocketDisconnect, WebSocketState
 from dotenv import load_dotenv
 
+# Run as a script (and in spawned workers), make "voice_server:app" resolve to this module
+if __name__ in ('__main__', '__mp_main__'):
+    sys.modules.setdefault('voice_server', sys.modules[__name__])
+
 load_dotenv()
 
 # Configuration
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 PORT = int(os.getenv('PORT', 10000))  # Use the Render port
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')  # DEBUG also logs full event payloads
+# Relay audio payloads untouched using pre-serialized frame templates
+FAST_RELAY = os.getenv('FAST_RELAY', 'true').lower() in ('1', 'true', 'yes')
+# Coalesce inbound audio into one append per window (e.g. 40-100 ms), 0 disables
+AUDIO_COALESCE_MS = int(os.getenv('AUDIO_COALESCE_MS', 0))
+ULAW_BYTES_PER_MS = 8  # 8 kHz μ-law, one byte per sample
+# Frames buffered per direction before caller audio is dropped or OpenAI reads wait
+RELAY_QUEUE_SIZE = int(os.getenv('RELAY_QUEUE_SIZE', 50))
+OPENAI_REALTIME_URL = os.getenv(
+    'OPENAI_REALTIME_URL',
+    'wss://api.openai.com/v1/realtime?model=gpt-4o-realtime-preview-2024-10-01'
+)
+# Pre-connected, pre-initialized realtime sockets kept warm for new calls, 0 disables
+OPENAI_POOL_SIZE = int(os.getenv('OPENAI_POOL_SIZE', 1))
+# Warm sockets older than this many seconds are replaced before being handed out
+OPENAI_POOL_MAX_AGE = int(os.getenv('OPENAI_POOL_MAX_AGE', 300))
+# Play the greeting from cached audio instead of generating it on every call
+GREETING_CACHE = os.getenv('GREETING_CACHE', 'true').lower() in ('1', 'true', 'yes')
+GREETING_CACHE_DIR = os.getenv('GREETING_CACHE_DIR', '.greeting_cache')  # Empty keeps it in memory only
+# Collect style changes for this long before sending one session.update, 0 sends at once
+STYLE_DEBOUNCE_MS = int(os.getenv('STYLE_DEBOUNCE_MS', 250))
+# Detect the caller talking over the assistant locally instead of waiting for OpenAI's VAD (needs numpy)
+LOCAL_VAD = os.getenv('LOCAL_VAD', 'false').lower() in ('1', 'true', 'yes')
+LOCAL_VAD_RMS = float(os.getenv('LOCAL_VAD_RMS', 1000))  # Frame energy threshold, 16-bit linear scale
+LOCAL_VAD_MAX_ZCR = float(os.getenv('LOCAL_VAD_MAX_ZCR', 0.35))  # Higher zero-crossing rates are hiss, not voice
+LOCAL_VAD_MIN_MS = int(os.getenv('LOCAL_VAD_MIN_MS', 60))  # Sustained speech needed before cutting the assistant off
+# Assistant audio per Twilio mark; smaller is a more exact truncate, larger is less chatter
+PLAYBACK_MARK_MS = int(os.getenv('PLAYBACK_MARK_MS', 200))
+# Call records (transcripts, styles, timing) appended as JSONL by a background task, empty disables
+CALL_LOG_PATH = os.getenv('CALL_LOG_PATH', 'call_logs/calls.jsonl')
+CALL_LOG_MAX_BYTES = int(os.getenv('CALL_LOG_MAX_BYTES', 10 * 1024 * 1024))  # Rotate the file past this size
+CALL_LOG_BACKUPS = int(os.getenv('CALL_LOG_BACKUPS', 5))  # Rotated files kept as calls.jsonl.1 ... .N
+CALL_LOG_FLUSH_SECONDS = float(os.getenv('CALL_LOG_FLUSH_SECONDS', 2))  # Batch records for this long per write
+# Ask OpenAI for a transcript of the caller's audio, used for style detection and call records
+TRANSCRIBE_CALLER = os.getenv('TRANSCRIBE_CALLER', 'true').lower() in ('1', 'true', 'yes')
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')  # Bearer token for admin endpoints, disabled when unset
+# Server processes sharing the port; each runs its own event loop, pool and metrics
+WORKERS = int(os.getenv('WORKERS', os.getenv('WEB_CONCURRENCY', 1)))
+UVICORN_LOOP = os.getenv('UVICORN_LOOP', 'auto')  # 'auto' uses uvloop when installed
+UVICORN_HTTP = os.getenv('UVICORN_HTTP', 'auto')  # 'auto' uses httptools when installed
+# Concurrent calls one worker takes before new callers are held or turned away, 0 is unlimited
+MAX_CALLS_PER_WORKER = int(os.getenv('MAX_CALLS_PER_WORKER', 0))
+OVERLOAD_HOLD_SECONDS = int(os.getenv('OVERLOAD_HOLD_SECONDS', 10))
+OVERLOAD_MAX_HOLDS = int(os.getenv('OVERLOAD_MAX_HOLDS', 3))  # 0 rejects at once
+# An answered call counts against the limit until its media stream connects, or for this long
+CALL_ADMIT_TIMEOUT = int(os.getenv('CALL_ADMIT_TIMEOUT', 30))
+# On SIGTERM, wait this long for active calls to end before shutting down anyway
+DRAIN_TIMEOUT = int(os.getenv('DRAIN_TIMEOUT', 280))
 SYSTEM_MESSAGE = """
 تحدث بالعربية الفصحى بلهجة سعودية. لا تستخدم لهجات مصرية أو غيرها.
 أنت مساعد صوتي افتراضي تابع لمدينة الملك عبدالعزيز للعلوم والتقنية (كاكست)، وتعمل كأنك موظف مركز اتصال سعودي.
@@ -66,264 +134,1302 @@ SYSTEM_MESSAGE = """
 قل له: "يعطيك العافية! مع السلامة ونتمنى لك يوم سعيد 😊"
 """
 VOICE = 'shimmer'  # Changed from 'sage' to 'shimmer' as requested
+GREETING_TEXT = "هلا وسهلا! معك أحمد من مركز اتصال كاكست، المساعد الذكي. كيف أقدر أساعدك اليوم؟"
+GREETING_PROMPT = (
+    "ابدأ المحادثة بترحيب طبيعي يشبه شاب سعودي في مركز الاتصال، واستخدم لهجة سعودية واضحة، وقل:\n"
+    + GREETING_TEXT
+)
+SESSION_CONFIG = {
+    "turn_detection": {"type": "server_vad"},
+    "input_audio_format": "g711_ulaw",
+    "output_audio_format": "g711_ulaw",
+    "voice": VOICE,
+    "instructions": SYSTEM_MESSAGE,
+    "modalities": ["text", "audio"],
+    "temperature": 0.7,
+}
+if TRANSCRIBE_CALLER:
+    SESSION_CONFIG["input_audio_transcription"] = {"model": "whisper-1"}
+# Heavy modules the health route doesn't need are imported after startup, see profile_startup()
+aiohttp = None  # Imported off the event loop by RealtimePool.start()
+np = None
+if LOCAL_VAD:
+    try:
+        import numpy as np  # Optional, enables the local barge-in VAD
+    except ImportError:
+        pass
+try:
+    import fcntl  # Serializes call log rotation between workers, POSIX only
+except ImportError:
+    fcntl = None
+
 LOG_EVENT_TYPES = [
     'error', 'response.content.done', 'rate_limits.updated',
     'response.done', 'input_audio_buffer.committed',
     'input_audio_buffer.speech_stopped', 'input_audio_buffer.speech_started',
-    'session.created'
+    'session.created', 'conversation.item.input_audio_transcription.completed'
 ]
 
-app = FastAPI()
+# Log records are queued on the event loop and written by a background thread,
+# so slow stdout never blocks the audio relay
+logger = logging.getLogger('voice_server')
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+log_queue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(log_queue))
+log_handler = logging.StreamHandler(sys.stdout)
+log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+log_listener = QueueListener(log_queue, log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+@asynccontextmanager
+async def lifespan(app):
+    """Keep the shared OpenAI client session and warm pool open while serving."""
+    # The pool starts in the background so the port opens without waiting on aiohttp
+    realtime_pool.launch()
+    greeting_cache.warm()
+    call_log.start()
+    lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+    try:
+        yield
+    finally:
+        lag_monitor.cancel()
+        await realtime_pool.close()
+        await call_log.close()
+
+app = FastAPI(lifespan=lifespan)
+
+# JSON helpers for the per-packet hot path; orjson is used when installed
+if FAST_RELAY and orjson is not None:
+    json_loads = orjson.loads
+
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode('utf-8')
+else:
+    json_loads = json.loads
+    json_dumps = json.dumps
+
+# Pre-serialized frame templates. Base64 payloads and Twilio stream SIDs never
+# contain characters that need JSON escaping, so they are spliced in as-is.
+AUDIO_APPEND_HEAD = '{"type":"input_audio_buffer.append","audio":"'
+TWILIO_MEDIA_HEAD = '{"event":"media","streamSid":"'
+TWILIO_MEDIA_MID = '","media":{"payload":"'
+TWILIO_MARK_HEAD = '{"event":"mark","streamSid":"'
+TWILIO_MARK_MID = '","mark":{"name":"'
+
+def openai_audio_append(payload):
+    """Build an input_audio_buffer.append frame around a base64 μ-law payload."""
+    if FAST_RELAY:
+        return AUDIO_APPEND_HEAD + payload + '"}'
+    return json.dumps({"type": "input_audio_buffer.append", "audio": payload})
+
+def twilio_media_frame(stream_sid, payload):
+    """Build a Twilio media frame around a base64 μ-law payload."""
+    if FAST_RELAY and stream_sid:
+        return TWILIO_MEDIA_HEAD + stream_sid + TWILIO_MEDIA_MID + payload + '"}}'
+    return json.dumps({"event": "media", "streamSid": stream_sid, "media": {"payload": payload}})
+
+def twilio_mark_frame(stream_sid, name):
+    """Build a Twilio mark frame for the given stream."""
+    if FAST_RELAY:
+        return TWILIO_MARK_HEAD + stream_sid + TWILIO_MARK_MID + name + '"}}'
+    return json.dumps({"event": "mark", "streamSid": stream_sid, "mark": {"name": name}})
+
+def ulaw_byte_count(payload):
+    """Decoded size of a base64 μ-law payload, without decoding it."""
+    return len(payload) * 3 // 4 - payload.count('=', len(payload) - 2)
+
+def ulaw_decode_table():
+    """G.711 μ-law byte to 16-bit linear sample, for all 256 byte values."""
+    ulaw = ~np.arange(256, dtype=np.int32) & 0xFF
+    magnitude = (((ulaw & 0x0F) << 3) + 0x84) << ((ulaw & 0x70) >> 4)
+    return np.where(ulaw & 0x80, 0x84 - magnitude, magnitude - 0x84).astype(np.float32)
+
+ULAW_TO_LINEAR = ulaw_decode_table() if np is not None else None
+
+# Metrics, exposed in Prometheus text format on /metrics
+METRICS = []
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Counter:
+    """Monotonic counter, optionally split into labelled children."""
+    kind = 'counter'
+
+    def __init__(self, name, help_text, register=True):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+        self.children = {}
+        if register:
+            METRICS.append(self)
+
+    def labels(self, **labels):
+        key = ','.join(f'{name}="{value}"' for name, value in sorted(labels.items()))
+        if key not in self.children:
+            self.children[key] = type(self)(self.name, self.help_text, register=False)
+        return self.children[key]
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        if not self.children:
+            return [f'{self.name} {self.value}']
+        return [f'{self.name}{{{key}}} {child.value}' for key, child in self.children.items()]
+
+    def render(self):
+        header = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+        return '\n'.join(header + self.samples())
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+class Histogram(Counter):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.bucket_counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def samples(self):
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, self.bucket_counts):
+            cumulative += bucket_count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{self.name}_sum {self.sum}')
+        lines.append(f'{self.name}_count {self.count}')
+        return lines
+
+def render_metrics():
+    return '\n'.join(metric.render() for metric in METRICS) + '\n'
+
+CALLS = Counter('voice_calls_total', 'Media streams accepted.')
+ACTIVE_CALLS = Gauge('voice_active_calls', 'Media streams currently relaying.')
+CALL_DURATION = Histogram('voice_call_duration_seconds', 'Media stream duration.',
+                          buckets=(10, 30, 60, 120, 300, 600, 1200, 1800))
+TIME_TO_FIRST_AUDIO = Histogram('voice_time_to_first_audio_seconds',
+                                'Stream accepted to first assistant audio sent to Twilio.')
+RESPONSE_LATENCY = Histogram('voice_response_latency_seconds',
+                             'input_audio_buffer.speech_stopped to the next response.audio.delta.')
+BARGE_IN_LATENCY = Histogram('voice_barge_in_latency_seconds',
+                             'Caller speech detected to the Twilio clear frame being sent.')
+AUDIO_FRAMES = Counter('voice_audio_frames_total', 'Audio frames relayed, by direction.')
+AUDIO_BYTES = Counter('voice_audio_bytes_total', 'μ-law audio bytes relayed, by direction.')
+AUDIO_APPENDS = Counter('voice_openai_audio_appends_total', 'input_audio_buffer.append messages sent to OpenAI.')
+COALESCE_DELAY = Histogram('voice_audio_coalesce_delay_seconds',
+                           'Time the oldest buffered caller frame waited before being sent.')
+DROPPED_FRAMES = Counter('voice_relay_dropped_frames_total',
+                         'Audio frames dropped because the receiving peer fell behind, by direction.')
+RELAY_STALLS = Counter('voice_relay_stalls_total',
+                       'Times a reader waited for room in a full send queue, by direction.')
+LOCAL_BARGE_INS = Counter('voice_local_barge_ins_total',
+                          'Assistant playback cut off by the local VAD before OpenAI reported speech.')
+DROPPED_CALL_RECORDS = Counter('voice_call_records_dropped_total',
+                               'Call records dropped because the call log writer fell behind or failed.')
+OVERLOADED_CALLS = Counter('voice_overloaded_calls_total',
+                           'Calls held, rejected or whose media stream was refused because the worker '
+                           'was full or draining, by outcome.')
+DRAINING = Gauge('voice_draining', '1 while the worker waits for active calls to end before shutting down.')
+EVENT_LOOP_LAG = Histogram('voice_event_loop_lag_seconds', 'Event loop scheduling delay.')
+FRAMES_IN, FRAMES_OUT = AUDIO_FRAMES.labels(direction='inbound'), AUDIO_FRAMES.labels(direction='outbound')
+BYTES_IN, BYTES_OUT = AUDIO_BYTES.labels(direction='inbound'), AUDIO_BYTES.labels(direction='outbound')
+
+class CallMetrics:
+    """Per-call timing marks, observed into the shared metrics."""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.first_audio_at = None
+        self.first_audio_queued = False
+        self.speech_stopped_at = None
+        CALLS.inc()
+        ACTIVE_CALLS.inc()
+
+    def audio_in(self, payload):
+        FRAMES_IN.inc()
+        BYTES_IN.inc(ulaw_byte_count(payload))
+
+    def audio_out(self, payload):
+        """Count an outbound chunk, returning a callback to run once it is actually sent.
+
+        Only the first chunk of the call and of each response is timed; for
+        the rest this returns None.
+        """
+        FRAMES_OUT.inc()
+        BYTES_OUT.inc(ulaw_byte_count(payload))
+        speech_stopped_at, self.speech_stopped_at = self.speech_stopped_at, None
+        first = not self.first_audio_queued
+        self.first_audio_queued = True
+        if not first and speech_stopped_at is None:
+            return None
+        return functools.partial(self.audio_sent, first, speech_stopped_at)
+
+    def audio_sent(self, first, speech_stopped_at):
+        now = time.perf_counter()
+        if first:
+            self.first_audio_at = now
+            TIME_TO_FIRST_AUDIO.observe(now - self.started_at)
+        if speech_stopped_at is not None:
+            RESPONSE_LATENCY.observe(now - speech_stopped_at)
+
+    def speech_stopped(self):
+        self.speech_stopped_at = time.perf_counter()
+
+    def finish(self):
+        ACTIVE_CALLS.dec()
+        CALL_DURATION.observe(time.perf_counter() - self.started_at)
+
+async def monitor_event_loop_lag(interval=0.25):
+    """Record how late the event loop wakes up a sleeping task."""
+    loop = asyncio.get_running_loop()
+    while True:
+        scheduled = loop.time() + interval
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - scheduled))
+
+if LOCAL_VAD and np is None:
+    logger.warning("LOCAL_VAD is set but numpy is not installed, relying on OpenAI's VAD")
 
 if not OPENAI_API_KEY:
     raise ValueError('Missing the OpenAI API key. Please set it in the .env file.')
 
+class LocalVAD:
+    """Energy and zero-crossing speech detector over inbound μ-law frames."""
+
+    def __init__(self, rms_threshold=LOCAL_VAD_RMS, max_zcr=LOCAL_VAD_MAX_ZCR, min_ms=LOCAL_VAD_MIN_MS):
+        self.rms_threshold = rms_threshold
+        self.max_zcr = max_zcr
+        self.min_bytes = min_ms * ULAW_BYTES_PER_MS
+        self.speech_bytes = 0
+
+    def is_speech(self, payload):
+        samples = ULAW_TO_LINEAR[np.frombuffer(base64.b64decode(payload), dtype=np.uint8)]
+        if samples.size < 2:
+            return False
+        rms = np.sqrt(np.mean(samples * samples))
+        signs = np.signbit(samples)
+        zcr = np.count_nonzero(signs[1:] != signs[:-1]) / (samples.size - 1)
+        return rms >= self.rms_threshold and zcr <= self.max_zcr
+
+    def feed(self, payload):
+        """Return True once per utterance, when speech has lasted min_ms."""
+        if not self.is_speech(payload):
+            self.speech_bytes = 0
+            return False
+        started = self.speech_bytes < self.min_bytes
+        self.speech_bytes += ulaw_byte_count(payload)
+        return started and self.speech_bytes >= self.min_bytes
+
+    def reset(self):
+        self.speech_bytes = 0
+
+class PlaybackTracker:
+    """Follow how much assistant audio Twilio has actually played, via marks.
+
+    Audio sent to Twilio is grouped into marks of about mark_ms each. Twilio
+    echoes a mark once the audio before it has played, so the acknowledged
+    μ-law bytes give the played time of the item being spoken.
+    """
+
+    def __init__(self, mark_ms=PLAYBACK_MARK_MS):
+        self.mark_bytes = max(1, mark_ms * ULAW_BYTES_PER_MS)
+        self.pending = deque()  # (mark number, item id, bytes) sent but not yet played
+        self.unmarked_item = None
+        self.unmarked_bytes = 0
+        self.played_item = None
+        self.played_bytes = 0
+        self.marks_sent = 0
+
+    @property
+    def playing(self):
+        return bool(self.pending or self.unmarked_bytes)
+
+    def sent(self, payload, item_id=None):
+        """Count an audio chunk sent to Twilio, returning a mark name when one is due."""
+        if self.unmarked_bytes and item_id != self.unmarked_item:
+            # Never let one mark span two items
+            name = self.mark()
+        else:
+            name = None
+        self.unmarked_item = item_id
+        self.unmarked_bytes += ulaw_byte_count(payload)
+        if self.unmarked_bytes >= self.mark_bytes:
+            return self.mark() if name is None else name
+        return name
+
+    def mark(self):
+        """Close the current group of audio, returning its mark name or None if empty."""
+        if not self.unmarked_bytes:
+            return None
+        self.marks_sent += 1
+        self.pending.append((self.marks_sent, self.unmarked_item, self.unmarked_bytes))
+        self.unmarked_bytes = 0
+        return f"audio{self.marks_sent}"
+
+    def acknowledged(self, name):
+        """Record that Twilio played up to the named mark; unknown names are ignored."""
+        # Mark numbers only grow, so a pending mark is found without scanning the deque
+        number = name[len('audio'):]
+        if not name.startswith('audio') or not number.isdigit():
+            return
+        number = int(number)
+        if not self.pending or not self.pending[0][0] <= number <= self.pending[-1][0]:
+            return  # Echo of a mark sent before the last clear
+        while self.pending:
+            mark_number, item_id, size = self.pending.popleft()
+            if item_id != self.played_item:
+                self.played_item, self.played_bytes = item_id, 0
+            self.played_bytes += size
+            if mark_number == number:
+                break
+
+    def interrupted(self):
+        """Item being played and how many ms of it were heard."""
+        if self.pending:
+            item_id = self.pending[0][1]
+        elif self.unmarked_bytes:
+            item_id = self.unmarked_item
+        else:
+            item_id = self.played_item
+        played_ms = self.played_bytes // ULAW_BYTES_PER_MS if item_id == self.played_item else 0
+        return item_id, played_ms
+
+    def reset(self):
+        self.pending.clear()
+        self.unmarked_item = None
+        self.unmarked_bytes = 0
+        self.played_item = None
+        self.played_bytes = 0
+
+class AudioCoalescer:
+    """Collect inbound μ-law payloads and emit one append frame per window."""
+
+    def __init__(self, window_ms):
+        self.window_bytes = window_ms * ULAW_BYTES_PER_MS
+        self.buffer = bytearray()
+        self.first_frame_at = None
+        self.frames_in = 0
+        self.writes_out = 0
+        self.delay_total = 0.0
+        self.delay_max = 0.0
+
+    def add(self, payload):
+        """Buffer a base64 payload, returning a frame once the window is full."""
+        if self.first_frame_at is None:
+            self.first_frame_at = time.perf_counter()
+        # Padded base64 chunks cannot be concatenated, so buffer the raw bytes
+        self.buffer += base64.b64decode(payload)
+        self.frames_in += 1
+        if len(self.buffer) >= self.window_bytes:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """Return a frame for whatever is buffered, or None if empty."""
+        if not self.buffer:
+            return None
+        delay = time.perf_counter() - self.first_frame_at
+        COALESCE_DELAY.observe(delay)
+        self.delay_total += delay
+        self.delay_max = max(self.delay_max, delay)
+        self.writes_out += 1
+        frame = openai_audio_append(base64.b64encode(self.buffer).decode('ascii'))
+        self.buffer.clear()
+        self.first_frame_at = None
+        return frame
+
+    def summary(self):
+        saved = self.frames_in - self.writes_out
+        avg_ms = self.delay_total / self.writes_out * 1000 if self.writes_out else 0.0
+        return (
+            f"Audio coalescing: {self.frames_in} frames in {self.writes_out} writes "
+            f"({saved} writes saved), added latency avg {avg_ms:.1f} ms, "
+            f"max {self.delay_max * 1000:.1f} ms"
+        )
+
+class RelayQueue:
+    """Bounded send queue for one direction of a call, drained by a writer task.
+
+    Control messages always wait for room. Audio frames do too unless
+    drop_audio is set, in which case the oldest queued audio frame is dropped
+    so the freshest audio gets through to a peer that has fallen behind.
+    """
+
+    def __init__(self, maxsize, direction, drop_audio):
+        self.maxsize = maxsize
+        self.drop_audio = drop_audio
+        self.items = deque()  # (is_audio, frame, on_sent)
+        self.changed = asyncio.Condition()
+        self.dropped = DROPPED_FRAMES.labels(direction=direction)
+        self.stalls = RELAY_STALLS.labels(direction=direction)
+
+    async def put(self, frame, audio=False, on_sent=None):
+        """Queue a frame; on_sent is called once the writer has sent it."""
+        async with self.changed:
+            if len(self.items) >= self.maxsize and not (audio and self.drop_audio and self.drop_oldest_audio()):
+                self.stalls.inc()
+                await self.changed.wait_for(lambda: len(self.items) < self.maxsize)
+            self.items.append((audio, frame, on_sent))
+            self.changed.notify_all()
+
+    def drop_oldest_audio(self):
+        for index, item in enumerate(self.items):
+            if item[0]:
+                del self.items[index]
+                self.dropped.inc()
+                return True
+        return False
+
+    async def discard_audio(self):
+        """Drop queued audio that has not been sent yet, e.g. on barge-in."""
+        async with self.changed:
+            self.items = deque(item for item in self.items if not item[0])
+            self.changed.notify_all()
+
+    async def drain(self, send):
+        """Writer task: send queued frames in order until cancelled."""
+        while True:
+            async with self.changed:
+                await self.changed.wait_for(lambda: self.items)
+                _, frame, on_sent = self.items.popleft()
+                self.changed.notify_all()
+            await send(frame)
+            if on_sent:
+                on_sent()
+
+class RealtimePool:
+    """Shared OpenAI client session with a few warm realtime sockets.
+
+    Warm sockets are connected and have already received the base
+    session.update, so a new call only needs to send its greeting. The pool
+    is refilled in the background whenever a socket is taken, ages out or is
+    dropped by the server while idle.
+    """
+
+    def __init__(self, size, max_age):
+        self.size = size
+        self.max_age = max_age
+        self.session = None
+        self.idle = deque()  # (created_at, openai_ws, watcher task), oldest first
+        self.wanted = asyncio.Event()
+        self.starting = None
+        self.refill_task = None
+
+    def launch(self):
+        self.starting = asyncio.create_task(self.start())
+
+    async def start(self):
+        global aiohttp
+        if aiohttp is None:
+            aiohttp = await asyncio.to_thread(importlib.import_module, 'aiohttp')
+        # Keep-alive and DNS caching so cold connects skip the lookup too
+        connector = aiohttp.TCPConnector(limit=0, ttl_dns_cache=300, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(connector=connector)
+        if self.size > 0:
+            self.refill_task = asyncio.create_task(self.refill())
+
+    async def close(self):
+        if self.starting:
+            await asyncio.gather(self.starting, return_exceptions=True)
+        if self.refill_task:
+            self.refill_task.cancel()
+            try:
+                await self.refill_task
+            except asyncio.CancelledError:
+                pass
+        while self.idle:
+            await self.retire(self.idle.popleft())
+        if self.session:
+            await self.session.close()
+
+    async def connect(self):
+        """Open a realtime socket and send the base session configuration."""
+        if self.session is None:
+            await self.starting  # Still importing aiohttp in the background
+        headers = {
+            "Authorization": f"Bearer {OPENAI_API_KEY}",
+            "OpenAI-Beta": "realtime=v1"
+        }
+        # Pings make a silently dropped connection fail instead of hanging
+        openai_ws = await self.session.ws_connect(OPENAI_REALTIME_URL, headers=headers, heartbeat=20)
+        await send_session_update(openai_ws)
+        return openai_ws
+
+    async def acquire(self):
+        """Return an initialized socket, taking a warm one when available."""
+        self.wanted.set()
+        while self.idle:
+            _, openai_ws, watcher = self.idle.pop()
+            watcher.cancel()
+            await asyncio.gather(watcher, return_exceptions=True)
+            if not openai_ws.closed:
+                return openai_ws
+        return await self.connect()
+
+    async def watch(self, openai_ws):
+        """Read an idle socket so a close from the server or network is noticed."""
+        async for msg in openai_ws:
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                event = json_loads(msg.data)
+                if event.get('type') == 'error':
+                    logger.error("Warm OpenAI socket error: %s", event.get('error'))
+                # session.created / session.updated need no action
+        logger.warning("Warm OpenAI socket closed while idle, replacing it")
+        self.idle = deque(entry for entry in self.idle if entry[1] is not openai_ws)
+        self.wanted.set()
+
+    async def retire(self, entry):
+        _, openai_ws, watcher = entry
+        watcher.cancel()
+        await asyncio.gather(watcher, return_exceptions=True)
+        await openai_ws.close()
+
+    async def refill(self):
+        """Top the pool up to size and replace sockets past max_age."""
+        while True:
+            while self.idle and time.monotonic() - self.idle[0][0] > self.max_age:
+                await self.retire(self.idle.popleft())
+            while len(self.idle) < self.size:
+                try:
+                    openai_ws = await self.connect()
+                except Exception as e:
+                    logger.error("Error pre-warming OpenAI connection: %s", e)
+                    await asyncio.sleep(5)
+                    continue
+                self.idle.append((time.monotonic(), openai_ws, asyncio.create_task(self.watch(openai_ws))))
+            self.wanted.clear()
+            try:
+                await asyncio.wait_for(self.wanted.wait(), timeout=self.max_age / 2)
+            except asyncio.TimeoutError:
+                pass
+
+realtime_pool = RealtimePool(OPENAI_POOL_SIZE, OPENAI_POOL_MAX_AGE)
+
+class GreetingCache:
+    """Cached g711_ulaw greeting audio, kept in memory and optionally on disk.
+
+    Entries are keyed by the voice, greeting prompt and session config, so
+    changing any of them misses the cache and the greeting is regenerated.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.key = hashlib.sha256(json.dumps(
+            {"voice": VOICE, "greeting": GREETING_PROMPT, "session": SESSION_CONFIG},
+            sort_keys=True
+        ).encode('utf-8')).hexdigest()[:16]
+        self.entry = None  # {"deltas": [...], "transcript": "..."}
+        self.refresh_task = None
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, f'greeting-{self.key}.json')
+
+    def lookup(self):
+        """Return the cached greeting, or None on a miss."""
+        return self.entry if GREETING_CACHE else None
+
+    def warm(self):
+        """Load the greeting from disk, generating it in the background on a miss."""
+        if not GREETING_CACHE:
+            return
+        if self.directory and os.path.exists(self.path):
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    self.entry = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning("Ignoring unreadable greeting cache %s: %s", self.path, e)
+            else:
+                logger.info("Loaded cached greeting %s", self.key)
+                return
+        self.refresh_task = asyncio.create_task(self.refresh())
+
+    async def refresh(self):
+        """Generate the greeting on a dedicated realtime socket and store it."""
+        try:
+            async with await realtime_pool.connect() as openai_ws:
+                entry = await asyncio.wait_for(generate_greeting(openai_ws), timeout=30)
+        except Exception as e:
+            logger.error("Error generating greeting cache: %s", e)
+            return False
+        if self.directory:
+            await asyncio.to_thread(self.write, entry)
+        self.entry = entry
+        logger.info("Cached greeting %s (%d audio chunks)", self.key, len(entry['deltas']))
+        return True
+
+    def write(self, entry):
+        os.makedirs(self.directory, exist_ok=True)
+        # Workers may regenerate the greeting at the same time, so never share the tmp file
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+greeting_cache = GreetingCache(GREETING_CACHE_DIR)
+
+class CallRecord:
+    """What happened on one call, kept in memory and persisted when it ends."""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.stream_sid = None
+        self.turns = []
+        self.styles = []
+        self.barge_ins = []
+
+    def offset_ms(self):
+        return int((time.perf_counter() - self.started) * 1000)
+
+    def caller(self, item_id, text):
+        self.turns.append({"at_ms": self.offset_ms(), "role": "caller", "item_id": item_id, "text": text})
+
+    def assistant(self, item_id, text):
+        self.turns.append({"at_ms": self.offset_ms(), "role": "assistant", "item_id": item_id, "text": text})
+
+    def style(self, style):
+        if not self.styles or self.styles[-1]["style"] != style:
+            self.styles.append({"at_ms": self.offset_ms(), "style": style})
+
+    def barge_in(self, item_id, audio_end_ms):
+        self.barge_ins.append({"at_ms": self.offset_ms(), "item_id": item_id, "audio_end_ms": audio_end_ms})
+
+    def finish(self, call_metrics):
+        first_audio_ms = None
+        if call_metrics.first_audio_at is not None:
+            first_audio_ms = int((call_metrics.first_audio_at - call_metrics.started_at) * 1000)
+        return {
+            "stream_sid": self.stream_sid,
+            "started_at": round(self.started_at, 3),
+            "duration_ms": self.offset_ms(),
+            "time_to_first_audio_ms": first_audio_ms,
+            "turns": self.turns,
+            "styles": self.styles,
+            "barge_ins": self.barge_ins,
+        }
+
+class CallLog:
+    """Append-only JSONL store for call records, rotated by size.
+
+    Calls only enqueue their record; a background task writes batches from a
+    thread so the relay loop never waits on disk. Records are dropped, not
+    waited for, if the writer falls behind.
+    """
+
+    def __init__(self, path, max_bytes=CALL_LOG_MAX_BYTES, backups=CALL_LOG_BACKUPS,
+                 flush_seconds=CALL_LOG_FLUSH_SECONDS, max_pending=1000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_seconds = flush_seconds
+        self.max_pending = max_pending
+        self.pending = deque()
+        self.ready = None
+        self.task = None
+
+    def start(self):
+        if self.path:
+            self.ready = asyncio.Event()
+            self.task = asyncio.create_task(self.run())
+
+    async def close(self):
+        """Stop the writer and flush whatever is still queued."""
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+            await self.flush()
+
+    def submit(self, record):
+        if self.task is None:
+            return
+        if len(self.pending) >= self.max_pending:
+            DROPPED_CALL_RECORDS.inc()
+            return
+        self.pending.append(record)
+        self.ready.set()
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            await asyncio.sleep(self.flush_seconds)  # Let records from other calls join the batch
+            self.ready.clear()
+            await self.flush()
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch = list(self.pending)
+        self.pending.clear()
+        try:
+            await asyncio.to_thread(self.write, batch)
+        except OSError as e:
+            DROPPED_CALL_RECORDS.inc(len(batch))
+            logger.error("Failed to write %d call record(s): %s", len(batch), e)
+
+    @contextmanager
+    def locked(self, exclusive):
+        """Hold a lock on a sidecar file, shared by every worker writing this log."""
+        with open(self.path + '.lock', 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def write(self, records):
+        data = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records).encode('utf-8')
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # The size check, rotation and append must not interleave with another worker's
+        with self.locked(exclusive=True):
+            try:
+                size = os.path.getsize(self.path)
+            except OSError:
+                size = 0
+            if size and size + len(data) > self.max_bytes:
+                self.rotate()
+            with open(self.path, 'ab') as f:
+                f.write(data)
+
+    def rotate(self):
+        """Shift calls.jsonl to calls.jsonl.1, .1 to .2 and so on, dropping the oldest."""
+        if self.backups < 1:
+            os.remove(self.path)
+            return
+        for index in range(self.backups - 1, 0, -1):
+            source = f'{self.path}.{index}'
+            if os.path.exists(source):
+                os.replace(source, f'{self.path}.{index + 1}')
+        os.replace(self.path, f'{self.path}.1')
+
+    def read(self, limit, style=None, since=None):
+        """Most recently finished calls first, optionally filtered by style or start time."""
+        records = []
+        if not os.path.exists(self.path):
+            return records
+        # A shared lock keeps rotation from moving files mid-scan
+        with self.locked(exclusive=False):
+            for path in [self.path] + [f'{self.path}.{index}' for index in range(1, self.backups + 1)]:
+                try:
+                    with open(path, encoding='utf-8') as f:
+                        lines = f.readlines()
+                except FileNotFoundError:
+                    break
+                for line in reversed(lines):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Partially written line
+                    if since is not None and record['started_at'] < since:
+                        continue  # Records are written when calls end, so start times are not in order
+                    if style and not any(entry['style'] == style for entry in record['styles']):
+                        continue
+                    records.append(record)
+                    if len(records) >= limit:
+                        return records
+        return records
+
+call_log = CallLog(CALL_LOG_PATH)
+
+# Response style keywords, in priority order: the first style with a match wins
+STYLE_KEYWORDS = [
+    ("رسمي", ["وظيفة", "توظيف", "تقديم", "فرص عمل"]),
+    ("تدريب تعاوني", ["تدريب تعاوني", "برنامج تعاوني", "فرصة تدريب", "تعاون أكاديمي"]),
+    ("معلومات اتصال", ["موقعكم", "رقم", "بريد", "تواصل", "عنوان"]),
+    ("تعريفي", ["كاكست", "ما هي", "وش كاكست", "تعريف"]),
+    ("دعم مشاريع", ["مشروع", "عندي مشروع", "أبغى دعم", "كيف أقدم على دعم", "عندي فكرة"]),
+    ("ابتكار", ["ابتكار", "أفكار جديدة", "حلول مبتكرة"]),
+    ("دعم طلاب", ["طلاب", "برنامج للطلاب", "دعم الطلاب", "طلبة", "فرصة طلابية", "أحتاج دعم دراسي"]),
+    ("طلب تحويل", ["حولني", "أبغى أكلم شخص", "حوّل المكالمة", "حول المكالمة"]),
+    ("وداع", ["شكراً", "خلاص", "مع السلامة"]),
+]
+DEFAULT_STYLE = "عام"
+
+# One translate table that drops diacritics and tatweel, folds alef/hamza/ya/
+# ta marbuta variants and turns any whitespace into a plain space
+ARABIC_FOLD = str.maketrans({
+    **{'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا', 'ى': 'ي', 'ؤ': 'و', 'ئ': 'ي', 'ة': 'ه'},
+    **dict.fromkeys([*range(0x0610, 0x061b), *range(0x064b, 0x0660), 0x0670, 0x0640, *range(0x06d6, 0x06ee)]),
+    **dict.fromkeys(map(ord, '\t\n\r\v\f\u00a0'), ' '),
+})
+
+def normalize_arabic(text):
+    """Fold Arabic spelling variants so e.g. "حوّل" and "حول" compare equal."""
+    return text.translate(ARABIC_FOLD)
+
+def compile_style_matcher(style_keywords):
+    """Compile all keywords into one regex plus a keyword -> priority map.
+
+    The alternation sits inside a lookahead so overlapping keywords are all
+    seen, behind a cheap check for a possible first letter. Alternatives are
+    listed in priority order so the best keyword at a position is reported.
+    """
+    priorities = {}
+    for priority, (_, keywords) in enumerate(style_keywords):
+        for keyword in keywords:
+            priorities.setdefault(normalize_arabic(keyword), priority)
+    ordered = sorted(priorities, key=lambda keyword: (priorities[keyword], -len(keyword)))
+    first_letters = re.escape(''.join(sorted({keyword[0] for keyword in ordered})))
+    pattern = re.compile(f'(?=[{first_letters}])(?=(' + '|'.join(map(re.escape, ordered)) + '))')
+    return pattern, priorities, max(map(len, priorities))
+
+STYLE_PATTERN, STYLE_PRIORITIES, STYLE_KEYWORD_MAX_LEN = compile_style_matcher(STYLE_KEYWORDS)
+
+class StyleClassifier:
+    """Incremental response style detection over a growing transcript.
+
+    Each delta is normalized and scanned once, together with a short tail of
+    the previous text so keywords split across deltas are still found. The
+    cost per delta stays constant however long the call's transcript gets.
+    """
+
+    def __init__(self):
+        self.tail = ""
+        self.best = len(STYLE_KEYWORDS)  # Priority of the best match so far
+
+    def feed(self, delta):
+        """Scan a new transcript delta and return the current style."""
+        if self.best:  # Nothing can outrank a priority 0 match
+            text = self.tail + normalize_arabic(delta)
+            for keyword in STYLE_PATTERN.findall(text):
+                self.best = min(self.best, STYLE_PRIORITIES[keyword])
+            self.tail = text[-(STYLE_KEYWORD_MAX_LEN - 1):]
+        return self.style
+
+    @property
+    def style(self):
+        return STYLE_KEYWORDS[self.best][0] if self.best < len(STYLE_KEYWORDS) else DEFAULT_STYLE
+
+# Style prompt prepended to the system message for each detected style
+STYLE_PROMPTS = {
+    "رسمي": "استخدم أسلوب رسمي ومهني بلهجة سعودية، وقدم الرد بطريقة دقيقة ولبقة.",
+    "تقني": "اشرح بشكل تقني ودقيق باستخدام لهجة سعودية واضحة، مع أمثلة إذا أمكن.",
+    "معلومات اتصال": "قدّم معلومات التواصل بوضوح تام ولباقة بلهجة سعودية.",
+    "تعريفي": "قدّم تعريفًا مبسطًا لكاكست بلهجة سعودية واضحة، مع أهم ما يميزها.",
+    "دعم مشاريع": "قدم معلومات عن كيفية تقديم المشاريع والأفكار للدعم من كاكست باستخدام تعبيرات سعودية مألوفة.",
+    "ابتكار": "قدم معلومات عن برامج الابتكار ودعم الأفكار الإبداعية في كاكست بلهجة سعودية واضحة.",
+    "دعم طلاب": "قدم معلومات عن برامج دعم الطلاب والفرص التعليمية في كاكست باستخدام أسلوب شاب سعودي ودود.",
+    "تدريب تعاوني": "قدم معلومات دقيقة عن برامج التدريب التعاوني وكيفية التقديم عليها باستخدام لهجة سعودية طبيعية.",
+    "طلب تحويل": "وضح بلطف أنك مساعد صوتي وقدم طرق التواصل البديلة، مستخدماً تعبيرات سعودية مثل 'يعطيك العافية' و'أبشر'.",
+    "وداع": "قدم عبارات الوداع المناسبة بلهجة سعودية محببة، مثل 'يعطيك العافية' و'مع السلامة' و'الله يحفظك'.",
+    DEFAULT_STYLE: "كن وديًا ولطيفًا بأسلوب شاب سعودي محترم، وقدم إجابات بلهجة سعودية واضحة وطبيعية وسهلة الفهم.",
+}
+
+def build_style_session_updates():
+    """Serialize one session.update per style, holding only what differs from SESSION_CONFIG."""
+    updates = {}
+    for style, style_prompt in STYLE_PROMPTS.items():
+        session = {"instructions": f"\n{style_prompt}\n\n{SYSTEM_MESSAGE}\n"}
+        diff = {key: value for key, value in session.items() if SESSION_CONFIG.get(key) != value}
+        updates[style] = json.dumps({"type": "session.update", "session": diff}, ensure_ascii=False)
+    return updates
+
+STYLE_SESSION_UPDATES = build_style_session_updates()
+
+class StyleUpdater:
+    """Per-call sender of style session.updates.
+
+    Nothing is sent while the style is unchanged, and styles detected within
+    the debounce window collapse into a single update with the latest one.
+    """
+
+    def __init__(self, send, debounce_ms):
+        self.send = send
+        self.debounce = debounce_ms / 1000
+        self.current = None  # The base SESSION_CONFIG instructions are active
+        self.pending = None
+        self.task = None
+
+    async def request(self, style):
+        self.pending = style
+        if not self.debounce:
+            await self.flush()
+        elif self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(self.debounce)
+        await self.flush()
+
+    async def flush(self):
+        style = self.pending
+        if style is None or style == self.current:
+            return
+        logger.info("Updating session with style: %s", style)
+        await self.send(STYLE_SESSION_UPDATES.get(style, STYLE_SESSION_UPDATES[DEFAULT_STYLE]))
+        self.current = style
+
+    def cancel(self):
+        if self.task:
+            self.task.cancel()
+
 # Updated function to detect response style based on user question
 def detect_response_style(user_text):
-    if any(word in user_text for word in ["وظيفة", "توظيف", "تقديم", "فرص عمل"]):
-        return "رسمي"
-    elif any(word in user_text for word in ["تدريب تعاوني", "برنامج تعاوني", "فرصة تدريب", "تعاون أكاديمي"]):
-        return "تدريب تعاوني"
-    elif any(word in user_text for word in ["موقعكم", "رقم", "بريد", "تواصل", "عنوان"]):
-        return "معلومات اتصال"
-    elif any(word in user_text for word in ["كاكست", "ما هي", "وش كاكست", "تعريف"]):
-        return "تعريفي"
-    elif any(word in user_text for word in ["مشروع", "عندي مشروع", "أبغى دعم", "كيف أقدم على دعم", "عندي فكرة"]):
-        return "دعم مشاريع"
-    elif any(word in user_text for word in ["ابتكار", "أفكار جديدة", "حلول مبتكرة"]):
-        return "ابتكار"
-    elif any(word in user_text for word in ["طلاب", "برنامج للطلاب", "دعم الطلاب", "طلبة", "فرصة طلابية", "أحتاج دعم دراسي"]):
-        return "دعم طلاب"
-    elif any(word in user_text for word in ["حولني", "أبغى أكلم شخص", "حوّل المكالمة", "حول المكالمة"]):
-        return "طلب تحويل"
-    elif any(word in user_text for word in ["شكراً", "خلاص", "مع السلامة"]):
-        return "وداع"
-    else:
-        return "عام"
+    return StyleClassifier().feed(user_text)
 
 @app.get("/", response_class=JSONResponse)
 async def index_page():
     return {"message": "Arabic Voice Assistant is running!"}
 
-@app.api_route("/incoming-call", methods=["GET", "POST"])
-async def handle_incoming_call(request: Request):
-    """Handle incoming call and return TwiML response to connect to Media Stream."""
+# TwiML only depends on the host and hold attempt, so each document is built once
+@functools.lru_cache(maxsize=32)
+def incoming_call_twiml(host):
+    from twilio.twiml.voice_response import VoiceResponse, Connect
     response = VoiceResponse()
     # Arabic greeting
     response.say("مرحباً، جاري توصيلك بالمساعد الصوتي الذكي")
     response.pause(length=1)
     response.say("يمكنك البدء بالتحدث الآن")
-    host = request.url.hostname
     connect = Connect()
     connect.stream(url=f'wss://{host}/media-stream')
     response.append(connect)
-    return HTMLResponse(content=str(response), media_type="application/xml")
+    return str(response)
+
+@functools.lru_cache(maxsize=None)
+def overload_twiml(attempt):
+    """Hold the caller and retry, or apologise and hang up after the last hold."""
+    from twilio.twiml.voice_response import VoiceResponse
+    response = VoiceResponse()
+    if attempt < OVERLOAD_MAX_HOLDS:
+        if attempt == 0:
+            response.say("جميع الخطوط مشغولة حالياً، نرجو الانتظار قليلاً")
+        response.pause(length=OVERLOAD_HOLD_SECONDS)
+        response.redirect(f'/incoming-call?attempt={attempt + 1}')
+    else:
+        response.say("نعتذر، جميع الخطوط مشغولة حالياً. نرجو الاتصال بنا لاحقاً، مع السلامة")
+        response.hangup()
+    return str(response)
+
+# Calls answered by this worker whose media stream hasn't connected yet, as admission times.
+# The greeting TwiML plays for a few seconds before <Connect>, and the stream may
+# land on another worker, so entries also expire after CALL_ADMIT_TIMEOUT.
+admitted_calls = deque()
+
+def worker_load():
+    """Active calls plus calls answered but not yet streaming."""
+    expired = time.monotonic() - CALL_ADMIT_TIMEOUT
+    while admitted_calls and admitted_calls[0] < expired:
+        admitted_calls.popleft()
+    return ACTIVE_CALLS.value + len(admitted_calls)
+
+@app.api_route("/incoming-call", methods=["GET", "POST"])
+async def handle_incoming_call(request: Request):
+    """Handle incoming call and return TwiML response to connect to Media Stream."""
+    if DRAINING.value or (MAX_CALLS_PER_WORKER and worker_load() >= MAX_CALLS_PER_WORKER):
+        try:
+            attempt = min(max(int(request.query_params.get('attempt', 0)), 0), OVERLOAD_MAX_HOLDS)
+        except ValueError:
+            attempt = 0
+        outcome = 'held' if attempt < OVERLOAD_MAX_HOLDS else 'rejected'
+        OVERLOADED_CALLS.labels(outcome=outcome).inc()
+        return HTMLResponse(content=overload_twiml(attempt), media_type="application/xml")
+    admitted_calls.append(time.monotonic())
+    return HTMLResponse(content=incoming_call_twiml(request.url.hostname), media_type="application/xml")
+
+@app.post("/greeting-cache/refresh")
+async def refresh_greeting_cache(request: Request):
+    """Regenerate the cached greeting audio, e.g. after VOICE or the prompt changes."""
+    if not ADMIN_TOKEN or request.headers.get('Authorization') != f"Bearer {ADMIN_TOKEN}":
+        return JSONResponse({"error": "forbidden"}, status_code=403)
+    if not await greeting_cache.refresh():
+        return JSONResponse({"error": "greeting generation failed"}, status_code=502)
+    return {"key": greeting_cache.key, "chunks": len(greeting_cache.entry['deltas'])}
+
+@app.get("/metrics")
+async def metrics():
+    """Expose call latency histograms and relay counters for Prometheus (this worker only)."""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/calls")
+async def call_history(request: Request, limit: int = 50, style: str = None, since: float = None):
+    """Recent call records, newest first, with a count of the styles they used."""
+    if not ADMIN_TOKEN or request.headers.get('Authorization') != f"Bearer {ADMIN_TOKEN}":
+        return JSONResponse({"error": "forbidden"}, status_code=403)
+    if not CALL_LOG_PATH:
+        return JSONResponse({"error": "call log disabled"}, status_code=404)
+    records = await asyncio.to_thread(call_log.read, max(1, min(limit, 1000)), style, since)
+    styles = {}
+    for record in records:
+        for entry in record['styles']:
+            styles[entry['style']] = styles.get(entry['style'], 0) + 1
+    return JSONResponse({"calls": records, "styles": styles})
 
 @app.websocket("/media-stream")
 async def handle_media_stream(websocket: WebSocket):
     """Handle WebSocket connections between Twilio and OpenAI."""
-    print("Client connected")
+    logger.info("Client connected")
+    if admitted_calls:
+        admitted_calls.popleft()
+    # The stream can land on a different worker than the one that answered the call
+    if DRAINING.value or (MAX_CALLS_PER_WORKER and ACTIVE_CALLS.value >= MAX_CALLS_PER_WORKER):
+        logger.warning("Refusing media stream, worker is %s", "draining" if DRAINING.value else "full")
+        OVERLOADED_CALLS.labels(outcome='refused_stream').inc()
+        await websocket.close(code=1013)  # Try again later
+        return
     await websocket.accept()
+    call_metrics = CallMetrics()
+    call_record = CallRecord()
+    try:
+        await relay_call(websocket, call_metrics, call_record)
+    except WebSocketDisconnect:
+        logger.info("Client disconnected.")
+    finally:
+        call_metrics.finish()
+        call_log.submit(call_record.finish(call_metrics))
 
-    # Use aiohttp for the OpenAI connection
-    headers = {
-        "Authorization": f"Bearer {OPENAI_API_KEY}",
-        "OpenAI-Beta": "realtime=v1"
-    }
-    
-    async with aiohttp.ClientSession() as session:
-        async with session.ws_connect(
-            'wss://api.openai.com/v1/realtime?model=gpt-4o-realtime-preview-2024-10-01',
-            headers=headers
-        ) as openai_ws:
-            # Connection specific state
-            stream_sid = None
-            latest_media_timestamp = 0
-            last_assistant_item = None
-            mark_queue = []
-            response_start_timestamp_twilio = None
-            user_question = ""  # Add variable to store user's speech
-            
-            # Initialize session
-            await initialize_session(openai_ws)
-            
-            async def receive_from_twilio():
-                """Receive audio data from Twilio and send it to the OpenAI Realtime API."""
-                nonlocal stream_sid, latest_media_timestamp, user_question
-                try:
-                    async for message in websocket.iter_text():
-                        data = json.loads(message)
-                        if data['event'] == 'media':
-                            latest_media_timestamp = int(data['media']['timestamp']) if 'timestamp' in data['media'] else 0
-                            audio_append = {
-                                "type": "input_audio_buffer.append",
-                                "audio": data['media']['payload']
-                            }
-                            await openai_ws.send_str(json.dumps(audio_append))
-                        elif data['event'] == 'start':
-                            stream_sid = data['start']['streamSid']
-                            print(f"Incoming stream has started {stream_sid}")
-                            response_start_timestamp_twilio = None
-                            latest_media_timestamp = 0
-                            last_assistant_item = None
-                            user_question = ""  # Reset user question for new call
-                        elif data['event'] == 'mark':
-                            if mark_queue:
-                                mark_queue.pop(0)
-                except WebSocketDisconnect:
-                    print("Client disconnected.")
-
-            async def send_to_twilio():
-                """Receive events from the OpenAI Realtime API, send audio back to Twilio."""
-                nonlocal stream_sid, last_assistant_item, response_start_timestamp_twilio, user_question
-                try:
-                    async for msg in openai_ws:
-                        if msg.type == aiohttp.WSMsgType.TEXT:
-                            response = json.loads(msg.data)
-                            if response['type'] in LOG_EVENT_TYPES:
-                                print(f"Received event: {response['type']}", response)
-
-                            # Capture user's speech text to analyze for response style
-                            if response.get('type') == 'response.content.delta' and 'delta' in response:
-                                if response.get('content_block', {}).get('type') == 'user_input' and 'delta' in response:
-                                    user_question += response['delta']
-                                    
-                                    # When we get a complete user question, update the session with appropriate style
-                                    if response.get('content_block', {}).get('index') == 0 and response.get('content_block', {}).get('is_completed', False):
-                                        style = detect_response_style(user_question)
-                                        await update_session_style(openai_ws, style)
-
-                            if response.get('type') == 'response.audio.delta' and 'delta' in response:
-                                audio_payload = base64.b64encode(base64.b64decode(response['delta'])).decode('utf-8')
-                                audio_delta = {
-                                    "event": "media",
-                                    "streamSid": stream_sid,
-                                    "media": {
-                                        "payload": audio_payload
-                                    }
-                                }
-                                await websocket.send_json(audio_delta)
-
-                                if response_start_timestamp_twilio is None:
-                                    response_start_timestamp_twilio = latest_media_timestamp
-
-                                # Update last_assistant_item safely
-                                if response.get('item_id'):
-                                    last_assistant_item = response['item_id']
-
-                                await send_mark(websocket, stream_sid)
-
-                            # Handle speech interruption
-                            if response.get('type') == 'input_audio_buffer.speech_started':
-                                print("Speech started detected.")
-                                if last_assistant_item:
-                                    print(f"Interrupting response with id: {last_assistant_item}")
-                                    await handle_speech_started_event()
-                except Exception as e:
-                    print(f"Error in send_to_twilio: {e}")
-
-            async def handle_speech_started_event():
-                """Handle interruption when the caller's speech starts."""
-                nonlocal response_start_timestamp_twilio, last_assistant_item
-                print("Handling speech started event.")
-                if mark_queue and response_start_timestamp_twilio is not None:
-                    elapsed_time = latest_media_timestamp - response_start_timestamp_twilio
-
-                    if last_assistant_item:
-                        truncate_event = {
-                            "type": "conversation.item.truncate",
-                            "item_id": last_assistant_item,
-                            "content_index": 0,
-                            "audio_end_ms": elapsed_time
-                        }
-                        await openai_ws.send_str(json.dumps(truncate_event))
-
-                    await websocket.send_json({
-                        "event": "clear",
-                        "streamSid": stream_sid
-                    })
-
-                    mark_queue.clear()
-                    last_assistant_item = None
-                    response_start_timestamp_twilio = None
-
-            async def send_mark(connection, stream_sid):
-                if stream_sid:
-                    mark_event = {
-                        "event": "mark",
-                        "streamSid": stream_sid,
-                        "mark": {"name": "responsePart"}
-                    }
-                    await connection.send_json(mark_event)
-                    mark_queue.append('responsePart')
-
-            # New function to update session based on detected style
-            async def update_session_style(openai_ws, style):
-                # Set style prompt based on detected style
-                if style == "رسمي":
-                    style_prompt = "استخدم أسلوب رسمي ومهني بلهجة سعودية، وقدم الرد بطريقة دقيقة ولبقة."
-                elif style == "تقني":
-                    style_prompt = "اشرح بشكل تقني ودقيق باستخدام لهجة سعودية واضحة، مع أمثلة إذا أمكن."
-                elif style == "معلومات اتصال":
-                    style_prompt = "قدّم معلومات التواصل بوضوح تام ولباقة بلهجة سعودية."
-                elif style == "تعريفي":
-                    style_prompt = "قدّم تعريفًا مبسطًا لكاكست بلهجة سعودية واضحة، مع أهم ما يميزها."
-                elif style == "دعم مشاريع":
-                    style_prompt = "قدم معلومات عن كيفية تقديم المشاريع والأفكار للدعم من كاكست باستخدام تعبيرات سعودية مألوفة."
-                elif style == "ابتكار":
-                    style_prompt = "قدم معلومات عن برامج الابتكار ودعم الأفكار الإبداعية في كاكست بلهجة سعودية واضحة."
-                elif style == "دعم طلاب":
-                    style_prompt = "قدم معلومات عن برامج دعم الطلاب والفرص التعليمية في كاكست باستخدام أسلوب شاب سعودي ودود."
-                elif style == "تدريب تعاوني":
-                    style_prompt = "قدم معلومات دقيقة عن برامج التدريب التعاوني وكيفية التقديم عليها باستخدام لهجة سعودية طبيعية."
-                elif style == "طلب تحويل":
-                    style_prompt = "وضح بلطف أنك مساعد صوتي وقدم طرق التواصل البديلة، مستخدماً تعبيرات سعودية مثل 'يعطيك العافية' و'أبشر'."
-                elif style == "وداع":
-                    style_prompt = "قدم عبارات الوداع المناسبة بلهجة سعودية محببة، مثل 'يعطيك العافية' و'مع السلامة' و'الله يحفظك'."
-                else:
-                    style_prompt = "كن وديًا ولطيفًا بأسلوب شاب سعودي محترم، وقدم إجابات بلهجة سعودية واضحة وطبيعية وسهلة الفهم."
-                
-                # Update the session with the appropriate style
-                session_update = {
-                    "type": "session.update",
-                    "session": {
-                        "turn_detection": {"type": "server_vad"},
-                        "input_audio_format": "g711_ulaw",
-                        "output_audio_format": "g711_ulaw",
-                        "voice": VOICE,
-                        "modalities": ["text", "audio"],
-                        "temperature": 0.7,
-                        "instructions": f"""
-{style_prompt}
-
-{SYSTEM_MESSAGE}
-""",
-                    }
+async def relay_call(websocket, call_metrics, call_record):
+    """Relay audio and events between an accepted Twilio stream and OpenAI."""
+
+    # Take a warm, already-initialized OpenAI socket from the shared pool
+    openai_connect = asyncio.create_task(realtime_pool.acquire())
+    stream_sid = None
+    playback = PlaybackTracker()
+
+    # On a cache hit the greeting plays while the OpenAI socket is still connecting
+    greeting = greeting_cache.lookup()
+    if greeting:
+        try:
+            stream_sid = await wait_for_stream_start(websocket)
+            call_record.stream_sid = stream_sid
+            if stream_sid:
+                # The greeting is a text item on the OpenAI side, so there is no item to truncate
+                for delta in greeting['deltas']:
+                    await websocket.send_text(twilio_media_frame(stream_sid, delta))
+                    audio_sent = call_metrics.audio_out(delta)
+                    if audio_sent:
+                        audio_sent()
+                    name = playback.sent(delta)
+                    if name:
+                        await websocket.send_text(twilio_mark_frame(stream_sid, name))
+                name = playback.mark()
+                if name:
+                    await websocket.send_text(twilio_mark_frame(stream_sid, name))
+        except BaseException:
+            # Caller hung up mid-greeting: don't leak the realtime socket being acquired
+            openai_connect.cancel()
+            result, = await asyncio.gather(openai_connect, return_exceptions=True)
+            if not isinstance(result, BaseException):
+                await result.close()
+            raise
+
+    openai_ws = await openai_connect
+    async with openai_ws:
+        if greeting and not stream_sid:
+            return  # Caller hung up before the stream started
+        # Connection specific state
+        style_classifier = StyleClassifier()
+        # Each direction gets its own bounded queue and writer task so a slow
+        # peer only holds up its own direction
+        to_openai = RelayQueue(RELAY_QUEUE_SIZE, 'inbound', drop_audio=True)
+        to_twilio = RelayQueue(RELAY_QUEUE_SIZE, 'outbound', drop_audio=False)
+        style_updater = StyleUpdater(to_openai.put, STYLE_DEBOUNCE_MS)
+        coalescer = AudioCoalescer(AUDIO_COALESCE_MS) if AUDIO_COALESCE_MS > 0 else None
+        local_vad = LocalVAD() if LOCAL_VAD and np is not None else None
+        generating_response = None  # Response whose audio is still streaming in
+        muted_response = None  # Response cut off by a local barge-in, its remaining audio is dropped
+        
+        # The pooled socket already has its session configured, just greet.
+        # A cached greeting has already played, so only add it to the context.
+        if greeting:
+            await send_greeting_context(openai_ws, greeting)
+        else:
+            await send_initial_conversation_item(openai_ws)
+        
+        async def receive_from_twilio():
+            """Receive audio data from Twilio and send it to the OpenAI Realtime API."""
+            nonlocal stream_sid, style_classifier
+            try:
+                async for message in websocket.iter_text():
+                    data = json_loads(message)
+                    if data['event'] == 'media':
+                        media = data['media']
+                        call_metrics.audio_in(media['payload'])
+                        if local_vad:
+                            # Only listen for barge-in while assistant audio is playing
+                            if not playback.playing:
+                                local_vad.reset()
+                            elif local_vad.feed(media['payload']):
+                                logger.info("Local VAD detected caller speech, interrupting.")
+                                LOCAL_BARGE_INS.inc()
+                                await handle_speech_started_event(time.perf_counter(), cancel_response=True)
+                        if coalescer:
+                            frame = coalescer.add(media['payload'])
+                            if frame:
+                                await to_openai.put(frame, audio=True)
+                                AUDIO_APPENDS.inc()
+                        else:
+                            # Pass the base64 payload through untouched
+                            await to_openai.put(openai_audio_append(media['payload']), audio=True)
+                            AUDIO_APPENDS.inc()
+                    elif data['event'] == 'start':
+                        stream_sid = data['start']['streamSid']
+                        call_record.stream_sid = stream_sid
+                        logger.info("Incoming stream has started %s", stream_sid)
+                        playback.reset()
+                        style_classifier = StyleClassifier()
+                    elif data['event'] == 'mark':
+                        await flush_inbound_audio()
+                        playback.acknowledged(data['mark']['name'])
+                    elif data['event'] == 'stop':
+                        await flush_inbound_audio()
+            except WebSocketDisconnect:
+                logger.info("Client disconnected.")
+
+        async def flush_inbound_audio():
+            """Send any coalesced caller audio to OpenAI right away."""
+            if coalescer:
+                frame = coalescer.flush()
+                if frame:
+                    await to_openai.put(frame, audio=True)
+                    AUDIO_APPENDS.inc()
+
+        async def send_to_twilio():
+            """Receive events from the OpenAI Realtime API, send audio back to Twilio."""
+            nonlocal stream_sid, generating_response
+            try:
+                async for msg in openai_ws:
+                    if msg.type == aiohttp.WSMsgType.TEXT:
+                        response = json_loads(msg.data)
+                        if response['type'] in LOG_EVENT_TYPES:
+                            logger.info("Received event: %s", response['type'])
+                            logger.debug("Event payload: %s", msg.data)
+                        if response['type'] == 'input_audio_buffer.speech_stopped':
+                            call_metrics.speech_stopped()
+
+                        # Capture user's speech text to analyze for response style
+                        if response.get('type') == 'response.content.delta' and 'delta' in response:
+                            if response.get('content_block', {}).get('type') == 'user_input' and 'delta' in response:
+                                style_classifier.feed(response['delta'])
+                                
+                                # When we get a complete user question, update the session with appropriate style
+                                if response.get('content_block', {}).get('index') == 0 and response.get('content_block', {}).get('is_completed', False):
+                                    call_record.style(style_classifier.style)
+                                    await style_updater.request(style_classifier.style)
+
+                        if response['type'] == 'conversation.item.input_audio_transcription.completed':
+                            transcript = response.get('transcript', '')
+                            call_record.caller(response.get('item_id'), transcript)
+                            call_record.style(style_classifier.feed(transcript))
+                            await style_updater.request(style_classifier.style)
+
+                        if response['type'] == 'response.audio_transcript.done':
+                            call_record.assistant(response.get('item_id'), response.get('transcript', ''))
+
+                        if response['type'] == 'response.done':
+                            generating_response = None
+
+                        if (response.get('type') == 'response.audio.delta' and 'delta' in response
+                                and (muted_response is None or response.get('response_id') != muted_response)):
+                            generating_response = response.get('response_id')
+                            # The delta is already base64 g711_ulaw, relay it as-is
+                            await to_twilio.put(twilio_media_frame(stream_sid, response['delta']), audio=True,
+                                                on_sent=call_metrics.audio_out(response['delta']))
+                            await send_mark(stream_sid, playback.sent(response['delta'], response.get('item_id')))
+
+                        if response['type'] == 'response.audio.done':
+                            # Mark the tail of the item so all of it is accounted for
+                            await send_mark(stream_sid, playback.mark())
+
+                        # Handle speech interruption
+                        if response.get('type') == 'input_audio_buffer.speech_started':
+                            detected_at = time.perf_counter()
+                            logger.info("Speech started detected.")
+                            await flush_inbound_audio()
+                            if playback.playing:
+                                await handle_speech_started_event(detected_at)
+            except Exception as e:
+                logger.error("Error in send_to_twilio: %s", e)
+
+        async def handle_speech_started_event(detected_at, cancel_response=False):
+            """Handle interruption when the caller's speech starts.
+
+            OpenAI's server VAD cancels its own response; a local barge-in has to
+            cancel it and drop the audio still in flight for it.
+            """
+            nonlocal generating_response, muted_response
+            logger.info("Handling speech started event.")
+            if not playback.playing:
+                return
+            if cancel_response and generating_response:
+                await to_openai.put(json_dumps({"type": "response.cancel"}))
+                muted_response, generating_response = generating_response, None
+            item_id, audio_end_ms = playback.interrupted()
+            if item_id:
+                logger.info("Interrupting response with id: %s at %d ms", item_id, audio_end_ms)
+                call_record.barge_in(item_id, audio_end_ms)
+                truncate_event = {
+                    "type": "conversation.item.truncate",
+                    "item_id": item_id,
+                    "content_index": 0,
+                    "audio_end_ms": audio_end_ms
                 }
-                print(f"Updating session with style: {style}")
-                await openai_ws.send_str(json.dumps(session_update))
-
-            await asyncio.gather(receive_from_twilio(), send_to_twilio())
-
-async def initialize_session(openai_ws):
-    """Control initial session with OpenAI."""
-    session_update = {
-        "type": "session.update",
-        "session": {
-            "turn_detection": {"type": "server_vad"},
-            "input_audio_format": "g711_ulaw",
-            "output_audio_format": "g711_ulaw",
-            "voice": VOICE,
-            "instructions": SYSTEM_MESSAGE,
-            "modalities": ["text", "audio"],
-            "temperature": 0.7,
-        }
-    }
-    print('Sending session update:', json.dumps(session_update))
-    await openai_ws.send_str(json.dumps(session_update))
+                await to_openai.put(json_dumps(truncate_event))
 
-    # Have the AI speak first with an updated Saudi greeting
-    await send_initial_conversation_item(openai_ws)
+            # Queued assistant audio would only be cleared again, so never send it
+            await to_twilio.discard_audio()
+            await to_twilio.put(json_dumps({
+                "event": "clear",
+                "streamSid": stream_sid
+            }), on_sent=lambda: BARGE_IN_LATENCY.observe(time.perf_counter() - detected_at))
+            playback.reset()
+
+        async def send_mark(stream_sid, name):
+            if stream_sid and name:
+                await to_twilio.put(twilio_mark_frame(stream_sid, name))
+
+        tasks = [
+            asyncio.create_task(receive_from_twilio()),
+            asyncio.create_task(send_to_twilio()),
+            asyncio.create_task(to_openai.drain(openai_ws.send_str)),
+            asyncio.create_task(to_twilio.drain(websocket.send_text)),
+        ]
+        try:
+            # When either leg ends, tear down the other instead of leaving it open
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception():
+                    logger.error("Relay task failed: %r", task.exception())
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            style_updater.cancel()
+            if coalescer:
+                logger.info(coalescer.summary())
+
+    if websocket.client_state == WebSocketState.CONNECTED:
+        try:
+            await websocket.close()
+        except RuntimeError:
+            pass  # Twilio closed it in the meantime
+
+SESSION_UPDATE = json.dumps({"type": "session.update", "session": SESSION_CONFIG}, ensure_ascii=False)
+
+async def send_session_update(openai_ws):
+    """Send the base session configuration."""
+    logger.info("Sending session update")
+    logger.debug("Session update payload: %s", SESSION_UPDATE)
+    await openai_ws.send_str(SESSION_UPDATE)
 
 async def send_initial_conversation_item(openai_ws):
     """Send initial conversation item for AI to greet in Saudi Arabic style."""
@@ -335,10 +1441,7 @@ async def send_initial_conversation_item(openai_ws):
             "content": [
                 {
                     "type": "input_text",
-                    "text": (
-                        "ابدأ المحادثة بترحيب طبيعي يشبه شاب سعودي في مركز الاتصال، واستخدم لهجة سعودية واضحة، وقل:\n"
-                        "هلا وسهلا! معك أحمد من مركز اتصال كاكست، المساعد الذكي. كيف أقدر أساعدك اليوم؟"
-                    )
+                    "text": GREETING_PROMPT
                 }
             ]
         }
@@ -346,7 +1449,195 @@ async def send_initial_conversation_item(openai_ws):
     await openai_ws.send_str(json.dumps(initial_conversation_item))
     await openai_ws.send_str(json.dumps({"type": "response.create"}))
 
-if __name__ == "__main__":
+async def send_greeting_context(openai_ws, greeting):
+    """Add the cached greeting to the conversation as the assistant's first turn."""
+    greeting_item = {
+        "type": "conversation.item.create",
+        "item": {
+            "type": "message",
+            "role": "assistant",
+            "content": [
+                {
+                    "type": "text",
+                    "text": greeting.get('transcript') or GREETING_TEXT
+                }
+            ]
+        }
+    }
+    await openai_ws.send_str(json.dumps(greeting_item))
+
+async def generate_greeting(openai_ws):
+    """Have the model speak the greeting once and collect its audio and transcript."""
+    await send_initial_conversation_item(openai_ws)
+    deltas = []
+    transcript = ""
+    async for msg in openai_ws:
+        if msg.type != aiohttp.WSMsgType.TEXT:
+            break
+        response = json_loads(msg.data)
+        if response['type'] == 'response.audio.delta':
+            deltas.append(response['delta'])
+        elif response['type'] == 'response.audio_transcript.delta':
+            transcript += response['delta']
+        elif response['type'] == 'error':
+            raise RuntimeError(response.get('error'))
+        elif response['type'] == 'response.done':
+            status = response.get('response', {}).get('status', 'completed')
+            if status != 'completed' or not deltas:
+                raise RuntimeError(f"greeting response {status} without audio")
+            return {"deltas": deltas, "transcript": transcript}
+    raise RuntimeError("OpenAI socket closed before the greeting finished")
+
+async def wait_for_stream_start(websocket):
+    """Read Twilio events up to the start event and return its stream SID."""
+    try:
+        async for message in websocket.iter_text():
+            data = json_loads(message)
+            if data['event'] == 'start':
+                stream_sid = data['start']['streamSid']
+                logger.info("Incoming stream has started %s", stream_sid)
+                return stream_sid
+    except WebSocketDisconnect:
+        logger.info("Client disconnected.")
+    return None
+
+async def regenerate_greeting_cache():
+    realtime_pool.size = 0  # No need to pre-warm call sockets for a one-off refresh
+    await realtime_pool.start()
+    try:
+        return await greeting_cache.refresh()
+    finally:
+        await realtime_pool.close()
+
+def create_server(config):
+    """Build a uvicorn server that lets active calls finish on the first SIGTERM/SIGINT."""
+    import uvicorn
+
+    class DrainingServer(uvicorn.Server):
+        async def startup(self, sockets=None):
+            self.loop = asyncio.get_running_loop()
+            await super().startup(sockets=sockets)
+
+        def handle_exit(self, sig, frame):
+            # A second signal, or nothing to wait for, shuts down right away
+            if DRAINING.value or not ACTIVE_CALLS.value or not hasattr(self, 'loop'):
+                return super().handle_exit(sig, frame)
+            DRAINING.set(1)
+            self.loop.call_soon_threadsafe(self.loop.create_task, self.drain(sig))
+
+        async def drain(self, sig):
+            # Stop accepting connections so new media streams go to other workers
+            for server in self.servers:
+                server.close()
+            logger.info("Draining %d active call(s), up to %ss", ACTIVE_CALLS.value, DRAIN_TIMEOUT)
+            deadline = time.monotonic() + DRAIN_TIMEOUT
+            while ACTIVE_CALLS.value and time.monotonic() < deadline and not self.should_exit:
+                await asyncio.sleep(0.5)
+            if ACTIVE_CALLS.value:
+                logger.warning("Drain timeout, closing %d active call(s)", ACTIVE_CALLS.value)
+            super().handle_exit(sig, None)
+
+    return DrainingServer(config)
+
+def server_config(app_target):
     import uvicorn
-    print(f"✅ Arabic voice assistant is running on port {PORT}")
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
+    return uvicorn.Config(app_target, host="0.0.0.0", port=PORT, loop=UVICORN_LOOP, http=UVICORN_HTTP,
+                          log_level=LOG_LEVEL.lower())
+
+def run_worker(sockets=None):
+    """Entry point of a spawned worker process."""
+    create_server(server_config("voice_server:app")).run(sockets=sockets)
+
+def supervise(workers):
+    """Share one listening socket between worker processes, restarting any that crash.
+
+    SIGTERM is forwarded so every worker drains its own calls; a second SIGTERM
+    forces them down. Ctrl-C already reaches the whole process group.
+    """
+    import multiprocessing
+    multiprocessing.allow_connection_pickling()  # Lets the bound socket be handed to spawned workers
+    context = multiprocessing.get_context('spawn')
+    sock = server_config("voice_server:app").bind_socket()
+    stopping = []
+
+    def spawn():
+        process = context.Process(target=run_worker, kwargs={'sockets': [sock]})
+        process.start()
+        return process
+
+    def stop(sig, frame):
+        stopping.append(sig)
+        if sig == signal.SIGTERM:
+            for process in processes:
+                if process.is_alive():
+                    os.kill(process.pid, signal.SIGTERM)
+
+    processes = [spawn() for _ in range(workers)]
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while any(process.is_alive() for process in processes) or not stopping:
+        if not stopping:
+            for index, process in enumerate(processes):
+                if not process.is_alive():
+                    logger.warning("Worker %s exited with %s, restarting", process.pid, process.exitcode)
+                    processes[index] = spawn()
+        time.sleep(0.5)
+    sock.close()
+
+def serve():
+    """Run the server with WORKERS processes."""
+    logger.info("✅ Arabic voice assistant is running on port %s with %d worker(s)", PORT, WORKERS)
+    if WORKERS > 1:
+        logger.warning("/metrics reports only the worker that answers each scrape when WORKERS > 1")
+        supervise(WORKERS)
+    else:
+        create_server(server_config(app)).run()
+
+def profile_startup(top=15):
+    """Print the cold-start import time of this module, broken down by package.
+
+    Modules deferred until after the port opens are timed separately, so a
+    new top-level import shows up here before it shows up in cold starts.
+    """
+    import subprocess
+    deferred = ['aiohttp', 'twilio.twiml.voice_response'] + (['numpy'] if not LOCAL_VAD else [])
+    code = (
+        "import sys, time, importlib\n"
+        "started = time.perf_counter()\n"
+        "import voice_server\n"
+        "print(time.perf_counter() - started)\n"
+        "sys.stderr.write('deferred\\n')\n"
+        f"for name in {deferred!r}:\n"
+        "    started = time.perf_counter()\n"
+        "    importlib.import_module(name)\n"
+        "    print(name, time.perf_counter() - started)\n"
+    )
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode:
+        print(result.stderr)
+        return 1
+    by_package = {}
+    for line in result.stderr.splitlines():
+        if line == 'deferred':
+            break
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        by_package[package] = by_package.get(package, 0) + int(self_us)
+    timings = result.stdout.split()
+    print(f"import voice_server: {float(timings[0]) * 1000:.0f} ms (under -X importtime)")
+    for package, self_us in sorted(by_package.items(), key=lambda item: -item[1])[:top]:
+        print(f"  {package:<28} {self_us / 1000:8.1f} ms")
+    print("deferred until after the port opens:")
+    for name, seconds in zip(timings[1::2], timings[2::2]):
+        print(f"  {name:<28} {float(seconds) * 1000:8.1f} ms")
+    return 0
+
+if __name__ == "__main__":
+    if '--refresh-greeting' in sys.argv:
+        sys.exit(0 if asyncio.run(regenerate_greeting_cache()) else 1)
+    if '--profile-startup' in sys.argv:
+        sys.exit(profile_startup())
+    serve()